@@ -4,6 +4,7 @@ This module is the main widget for the plugin
 It implements the Widget specification.
 see: https://napari.org/plugins/guides.html?#widgets
 """
+import functools
 import warnings
 
 import dask.array as da
@@ -13,11 +14,21 @@ from napari.layers.shapes.shapes import Shapes
 from napari.utils.events.event import Event
 from napari.viewer import Viewer
 from qtpy.QtCore import Qt
-from qtpy.QtWidgets import QCheckBox, QComboBox, QFormLayout, QLabel, QPushButton, QVBoxLayout, QWidget
-from superqt import QCollapsible
+from qtpy.QtWidgets import (
+    QCheckBox,
+    QComboBox,
+    QDoubleSpinBox,
+    QFormLayout,
+    QLabel,
+    QPushButton,
+    QVBoxLayout,
+    QWidget,
+)
+from superqt import QCollapsible, QEnumComboBox
 
 from napari_crop_and_mask import core
-from napari_crop_and_mask._widget_utils import update_layer_combobox
+from napari_crop_and_mask._widget_utils import confirm_plan, execute_in_background, update_layer_combobox
+from napari_crop_and_mask.models import ExecutionMode, Scheduler
 
 
 class CropWidget(QWidget):
@@ -69,6 +80,25 @@ class CropWidget(QWidget):
         options_collapsible.setText("Advanced options")
         layout.addWidget(options_collapsible)
 
+        advanced_options_form_widget = QWidget()
+        advanced_options_form_layout = QFormLayout()
+        advanced_options_form_layout.setContentsMargins(0, 0, 0, 0)
+        advanced_options_form_widget.setLayout(advanced_options_form_layout)
+        options_collapsible.addWidget(advanced_options_form_widget)
+
+        # Execution policy of the result
+        self.execution_mode_combobox = QEnumComboBox(enum_class=ExecutionMode, parent=self)
+        advanced_options_form_layout.addRow("Execution", self.execution_mode_combobox)
+
+        self.memory_budget_spinbox = QDoubleSpinBox(parent=self)
+        self.memory_budget_spinbox.setRange(0.1, 1024)
+        self.memory_budget_spinbox.setValue(2)
+        self.memory_budget_spinbox.setSuffix(" GB")
+        advanced_options_form_layout.addRow("Memory budget", self.memory_budget_spinbox)
+
+        self.scheduler_combobox = QEnumComboBox(enum_class=Scheduler, parent=self)
+        advanced_options_form_layout.addRow("Scheduler", self.scheduler_combobox)
+
         # Treat as RGB
         self.is_rgb_checkbox = QCheckBox("Is RGB image", parent=self)
         options_collapsible.addWidget(self.is_rgb_checkbox)
@@ -81,6 +111,10 @@ class CropWidget(QWidget):
         self.inplace_crop_checkbox = QCheckBox(text="Inplace crop (translate layer)", parent=self)
         options_collapsible.addWidget(self.inplace_crop_checkbox)
 
+        # Add the output as a lazily computed pyramid
+        self.multiscale_checkbox = QCheckBox(text="Multiscale output (new layer only)", parent=self)
+        options_collapsible.addWidget(self.multiscale_checkbox)
+
         # Delete shape layer after cropping
         self.delete_shape_layer_checkbox = QCheckBox(text="Delete shape layer upon completion", parent=self)
         self.delete_shape_layer_checkbox.setChecked(True)
@@ -92,6 +126,11 @@ class CropWidget(QWidget):
         crop_button.clicked.connect(self.crop_button_clicked)
         layout.addWidget(crop_button)
 
+        # Estimate of the last operation
+        self.plan_label = QLabel(parent=self)
+        self.plan_label.setWordWrap(True)
+        layout.addWidget(self.plan_label)
+
         self.initialize_lists()
 
     def image_selection_changed(self):
@@ -135,7 +174,11 @@ class CropWidget(QWidget):
         is_rgb = self.is_rgb_checkbox.isChecked()
         is_overwrite_orginal = self.overwrite_orginal_checkbox.isChecked()
         is_delete_shape_layer = self.delete_shape_layer_checkbox.isChecked()
+        is_multiscale = self.multiscale_checkbox.isChecked()
         is_inplace_crop = self.inplace_crop_checkbox.isChecked()
+        execution_mode: ExecutionMode = self.execution_mode_combobox.currentEnum()
+        memory_budget = self.memory_budget_spinbox.value()
+        scheduler: Scheduler = self.scheduler_combobox.currentEnum()
 
         # Stopping condition 1
         if image_layer is None:
@@ -173,6 +216,23 @@ class CropWidget(QWidget):
         # Begin crop and mask
         shape_points = np.vstack(shape_data)
         dimension_min, dimension_max = core.get_bounding_box(shape_points)
+
+        # Multiscale levels are computed from the lazy result (and cached) when displayed
+        if is_multiscale is True and is_overwrite_orginal is False:
+            execution_mode = ExecutionMode.LAZY
+
+        # Estimate the cost before launching
+        plan = core.plan_operation(
+            image_data,
+            dimension_min,
+            dimension_max,
+            dimension_indicies,
+            execution_mode=execution_mode,
+            memory_budget=memory_budget * 1e9,
+        )
+        if not confirm_plan(plan, self.plan_label, self):
+            return
+
         cropped_image = core.crop_mask_hyperrectangle(
             image=image_data,
             dimension_max=dimension_max,
@@ -181,14 +241,52 @@ class CropWidget(QWidget):
             is_mask_only=False,
             mask_value=None,
             is_invert_selection=False,
+            strategy=plan.strategy,
+        )
+
+        # Execute the result according to the policy (in the background), then show it
+        on_executed = functools.partial(
+            self.show_result,
+            image_layer=image_layer,
+            shape_layer=shape_layer,
+            dimension_min=dimension_min,
+            dimension_indicies=dimension_indicies,
+            is_overwrite_orginal=is_overwrite_orginal,
+            is_multiscale=is_multiscale,
+            is_inplace_crop=is_inplace_crop,
+            is_delete_shape_layer=is_delete_shape_layer,
         )
+        execute_in_background(
+            cropped_image,
+            on_executed,
+            execution_mode=plan.execution_mode,
+            memory_budget=memory_budget * 1e9,
+            scheduler=scheduler,
+        )
+
+    def show_result(
+        self,
+        cropped_image: da.Array,
+        image_layer: Image,
+        shape_layer: Shapes,
+        dimension_min: np.ndarray,
+        dimension_indicies: list,
+        is_overwrite_orginal: bool,
+        is_multiscale: bool,
+        is_inplace_crop: bool,
+        is_delete_shape_layer: bool,
+    ):
+        """Adds the (executed) cropped image as a layer or replaces the original"""
 
         # Add/update layer
         if is_overwrite_orginal is False:
+            if is_multiscale:
+                cropped_image = core.multiscale_pyramid(cropped_image, dimension_indicies)
             cropped_image_layer = self.add_similar_image_layer(
                 data=cropped_image,
                 name=image_layer.name + "(cropped)",
                 reference_layer=image_layer,
+                is_multiscale=is_multiscale,
             )
         else:
             cropped_image_layer = image_layer
@@ -206,11 +304,12 @@ class CropWidget(QWidget):
         if is_delete_shape_layer is True:
             self.viewer.layers.remove(shape_layer)
 
-    def add_similar_image_layer(self, data, name: str, reference_layer: Image) -> Image:
+    def add_similar_image_layer(self, data, name: str, reference_layer: Image, is_multiscale: bool = False) -> Image:
         """Adds a new image layer similar to a reference layer"""
         layer = self.viewer.add_image(
             data,
             name=name,
+            multiscale=is_multiscale,
             opacity=reference_layer.opacity,
             gamma=reference_layer.gamma,
             contrast_limits=reference_layer.contrast_limits,
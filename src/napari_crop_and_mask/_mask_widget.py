@@ -4,7 +4,9 @@ This module is the main widget for the plugin
 It implements the Widget specification.
 see: https://napari.org/plugins/guides.html?#widgets
 """
+import functools
 import warnings
+from typing import Optional
 
 import dask.array as da
 import numpy as np
@@ -13,12 +15,21 @@ from napari.layers.shapes.shapes import Shapes
 from napari.utils.events.event import Event
 from napari.viewer import Viewer
 from qtpy.QtCore import Qt
-from qtpy.QtWidgets import QCheckBox, QComboBox, QFormLayout, QLabel, QPushButton, QVBoxLayout, QWidget
+from qtpy.QtWidgets import (
+    QCheckBox,
+    QComboBox,
+    QDoubleSpinBox,
+    QFormLayout,
+    QLabel,
+    QPushButton,
+    QVBoxLayout,
+    QWidget,
+)
 from superqt import QCollapsible, QEnumComboBox
 
 from napari_crop_and_mask import core
-from napari_crop_and_mask._widget_utils import update_layer_combobox
-from napari_crop_and_mask.models import InclusionMode, MaskMode
+from napari_crop_and_mask._widget_utils import confirm_plan, execute_in_background, update_layer_combobox
+from napari_crop_and_mask.models import ExecutionMode, InclusionMode, MaskMode, Scheduler
 
 
 class MaskWidget(QWidget):
@@ -85,6 +96,19 @@ class MaskWidget(QWidget):
         self.inclusion_mode_combobox = QEnumComboBox(enum_class=InclusionMode, parent=self)
         advanced_options_form_layout.addRow("Inclusion mode", self.inclusion_mode_combobox)
 
+        # Execution policy of the result
+        self.execution_mode_combobox = QEnumComboBox(enum_class=ExecutionMode, parent=self)
+        advanced_options_form_layout.addRow("Execution", self.execution_mode_combobox)
+
+        self.memory_budget_spinbox = QDoubleSpinBox(parent=self)
+        self.memory_budget_spinbox.setRange(0.1, 1024)
+        self.memory_budget_spinbox.setValue(2)
+        self.memory_budget_spinbox.setSuffix(" GB")
+        advanced_options_form_layout.addRow("Memory budget", self.memory_budget_spinbox)
+
+        self.scheduler_combobox = QEnumComboBox(enum_class=Scheduler, parent=self)
+        advanced_options_form_layout.addRow("Scheduler", self.scheduler_combobox)
+
         # Treat as RGB
         self.is_rgb_checkbox = QCheckBox("Is RGB image", parent=self)
         options_collapsible.addWidget(self.is_rgb_checkbox)
@@ -93,6 +117,14 @@ class MaskWidget(QWidget):
         self.overwrite_orginal_checkbox = QCheckBox(text="Overwrite original image", parent=self)
         options_collapsible.addWidget(self.overwrite_orginal_checkbox)
 
+        # Trim the output to the extent of unmasked pixels
+        self.trim_checkbox = QCheckBox(text="Trim to unmasked extent (translate layer)", parent=self)
+        options_collapsible.addWidget(self.trim_checkbox)
+
+        # Add the output as a lazily computed pyramid
+        self.multiscale_checkbox = QCheckBox(text="Multiscale output (new layer only)", parent=self)
+        options_collapsible.addWidget(self.multiscale_checkbox)
+
         # Delete shape layer after cropping
         self.delete_shape_layer_checkbox = QCheckBox(text="Delete shape layer upon completion", parent=self)
         self.delete_shape_layer_checkbox.setChecked(True)
@@ -104,6 +136,11 @@ class MaskWidget(QWidget):
         crop_button.clicked.connect(self.crop_button_clicked)
         layout.addWidget(crop_button)
 
+        # Estimate of the last operation
+        self.plan_label = QLabel(parent=self)
+        self.plan_label.setWordWrap(True)
+        layout.addWidget(self.plan_label)
+
         self.initialize_lists()
 
     def image_selection_changed(self):
@@ -147,8 +184,13 @@ class MaskWidget(QWidget):
         is_rgb = self.is_rgb_checkbox.isChecked()
         is_overwrite_orginal = self.overwrite_orginal_checkbox.isChecked()
         is_delete_shape_layer = self.delete_shape_layer_checkbox.isChecked()
+        is_multiscale = self.multiscale_checkbox.isChecked()
+        is_trim = self.trim_checkbox.isChecked()
         mask_mode: MaskMode = self.mask_mode_combobox.currentEnum()
         inclusion_mode: InclusionMode = self.inclusion_mode_combobox.currentEnum()
+        execution_mode: ExecutionMode = self.execution_mode_combobox.currentEnum()
+        memory_budget = self.memory_budget_spinbox.value()
+        scheduler: Scheduler = self.scheduler_combobox.currentEnum()
 
         is_invert_selection = inclusion_mode.is_invert_selection()
         mask_value = mask_mode.mask_value
@@ -187,10 +229,32 @@ class MaskWidget(QWidget):
         # Attempt to figure out the dimensions of indices
         dimension_indicies = core.infer_demension_indicies(len(image_data.shape), 2, is_rgb)
 
+        shape_points = np.vstack(shape_data)
+        dimension_min, dimension_max = core.get_bounding_box(shape_points)
+
+        # Multiscale levels are computed from the lazy result (and cached) when displayed
+        if is_multiscale is True and is_overwrite_orginal is False:
+            execution_mode = ExecutionMode.LAZY
+
+        # Estimate the cost before launching
+        plan = core.plan_operation(
+            image_data,
+            dimension_min,
+            dimension_max,
+            dimension_indicies,
+            is_mask_only=True,
+            mask_value=mask_value,
+            is_invert_selection=is_invert_selection,
+            is_trim=is_trim,
+            n_shapes=None if is_rectangular else len(shape_data),
+            execution_mode=execution_mode,
+            memory_budget=memory_budget * 1e9,
+        )
+        if not confirm_plan(plan, self.plan_label, self):
+            return
+
         # Begin mask
         if is_rectangular:
-            shape_points = np.vstack(shape_data)
-            dimension_min, dimension_max = core.get_bounding_box(shape_points)
             cropped_image = core.crop_mask_hyperrectangle(
                 image=image_data,
                 dimension_max=dimension_max,
@@ -199,6 +263,9 @@ class MaskWidget(QWidget):
                 is_mask_only=True,
                 mask_value=mask_value,
                 is_invert_selection=is_invert_selection,
+                is_trim=is_trim,
+                strategy=plan.strategy,
+                mask_layout=plan.mask_layout,
             )
         else:
             image_size = core.image_size(image_data, is_rgb=is_rgb)
@@ -209,28 +276,83 @@ class MaskWidget(QWidget):
                 mask_value=mask_value,
                 dimension_indicies=dimension_indicies,
                 is_invert_selection=is_invert_selection,
+                is_trim=is_trim,
+                mask_layout=plan.mask_layout,
             )
 
+        translation = None
+        if is_trim:
+            cropped_image, translation = cropped_image
+
+        # Stopping condition 4
+        if cropped_image.size == 0:
+            warnings.warn("nothing is left unmasked, the output would be empty")
+            return
+
+        # Execute the result according to the policy (in the background), then show it
+        on_executed = functools.partial(
+            self.show_result,
+            image_layer=image_layer,
+            shape_layer=shape_layer,
+            dimension_indicies=dimension_indicies,
+            translation=translation,
+            is_overwrite_orginal=is_overwrite_orginal,
+            is_multiscale=is_multiscale,
+            is_delete_shape_layer=is_delete_shape_layer,
+        )
+        execute_in_background(
+            cropped_image,
+            on_executed,
+            execution_mode=plan.execution_mode,
+            memory_budget=memory_budget * 1e9,
+            scheduler=scheduler,
+        )
+
+    def show_result(
+        self,
+        cropped_image: da.Array,
+        image_layer: Image,
+        shape_layer: Shapes,
+        dimension_indicies: list,
+        translation: Optional[np.ndarray],
+        is_overwrite_orginal: bool,
+        is_multiscale: bool,
+        is_delete_shape_layer: bool,
+    ):
+        """Adds the (executed) masked image as a layer or replaces the original"""
+
         # Add/update layer
         if is_overwrite_orginal is False:
+            if is_multiscale:
+                cropped_image = core.multiscale_pyramid(cropped_image, dimension_indicies)
             cropped_image_layer = self.add_similar_image_layer(
                 data=cropped_image,
                 name=image_layer.name + "(masked)",
                 reference_layer=image_layer,
+                is_multiscale=is_multiscale,
             )
         else:
             cropped_image_layer = image_layer
             cropped_image_layer.data = cropped_image
 
+        # Keep the trimmed output registered with the original image
+        if translation is not None:
+            translation = translation[: cropped_image_layer.ndim]
+            translation = translation * np.asarray(image_layer.scale)
+            cropped_image_layer.translate = np.asarray(image_layer.translate) + translation
+
         # Delete shape layer if required
         if is_delete_shape_layer is True:
             self.viewer.layers.remove(shape_layer)
 
-    def add_similar_image_layer(self, data, name: str, reference_layer: Image) -> Image:
+    def add_similar_image_layer(self, data, name: str, reference_layer: Image, is_multiscale: bool = False) -> Image:
         """Adds a new image layer similar to a reference layer"""
         layer = self.viewer.add_image(
             data,
             name=name,
+            multiscale=is_multiscale,
+            scale=reference_layer.scale,
+            translate=reference_layer.translate,
             opacity=reference_layer.opacity,
             gamma=reference_layer.gamma,
             contrast_limits=reference_layer.contrast_limits,
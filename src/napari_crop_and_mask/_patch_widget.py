@@ -0,0 +1,206 @@
+"""
+This module is the patch extraction widget for the plugin
+
+It implements the Widget specification.
+see: https://napari.org/plugins/guides.html?#widgets
+"""
+import warnings
+
+import dask.array as da
+from napari.layers.image.image import Image
+from napari.layers.shapes.shapes import Shapes
+from napari.utils.events.event import Event
+from napari.viewer import Viewer
+from qtpy.QtCore import Qt
+from qtpy.QtWidgets import (
+    QComboBox,
+    QDoubleSpinBox,
+    QFormLayout,
+    QLabel,
+    QLineEdit,
+    QPushButton,
+    QSpinBox,
+    QVBoxLayout,
+    QWidget,
+)
+from superqt import QCollapsible
+
+from napari_crop_and_mask import core
+from napari_crop_and_mask._widget_utils import update_layer_combobox
+
+
+class PatchWidget(QWidget):
+    """Patch Extraction Widget"""
+
+    def __init__(self, napari_viewer: Viewer):
+        super().__init__()
+        self.viewer = napari_viewer
+        self.setLayout(QVBoxLayout())
+        self.initialize_ui()
+
+    def initialize_ui(self):
+        """Initlizes the ui"""
+
+        # initialize layout
+        layout: QVBoxLayout = self.layout()
+        layout.setAlignment(Qt.AlignTop)
+        self.setMinimumWidth(350)
+        self.setMaximumWidth(500)
+        self.viewer.layers.events.inserted.connect(self.update_lists)
+        self.viewer.layers.events.removed.connect(self.update_lists)
+
+        # Label for the tool
+        label = QLabel(
+            "Select the layer you want to tile, " + "the shape layer with the regions and get going.",
+            self,
+        )
+        label.setWordWrap(True)
+        layout.addWidget(label)
+
+        options_form_widget = QWidget()
+        options_form_layout = QFormLayout()
+        options_form_widget.setLayout(options_form_layout)
+        layout.addWidget(options_form_widget)
+
+        # Add image layer selection
+        self.image_combobox = QComboBox(parent=self)
+        options_form_layout.addRow("Image to tile", self.image_combobox)
+
+        # Add shape layer selection
+        self.shape_combobox = QComboBox(parent=self)
+        options_form_layout.addRow("Regions shape", self.shape_combobox)
+
+        # Patch size
+        self.patch_size_spinbox = QSpinBox(parent=self)
+        self.patch_size_spinbox.setRange(1, 65536)
+        self.patch_size_spinbox.setValue(256)
+        options_form_layout.addRow("Patch size", self.patch_size_spinbox)
+
+        # Add advanced option
+        options_collapsible = QCollapsible()
+        options_collapsible.setText("Advanced options")
+        layout.addWidget(options_collapsible)
+
+        advanced_options_form_widget = QWidget()
+        advanced_options_form_layout = QFormLayout()
+        advanced_options_form_layout.setContentsMargins(0, 0, 0, 0)
+        advanced_options_form_widget.setLayout(advanced_options_form_layout)
+        options_collapsible.addWidget(advanced_options_form_widget)
+
+        # Overlap between patches
+        self.overlap_spinbox = QSpinBox(parent=self)
+        self.overlap_spinbox.setRange(0, 65535)
+        advanced_options_form_layout.addRow("Overlap", self.overlap_spinbox)
+
+        # Minimum fraction of pixels inside the regions
+        self.minimum_mask_fraction_spinbox = QDoubleSpinBox(parent=self)
+        self.minimum_mask_fraction_spinbox.setRange(0, 1)
+        self.minimum_mask_fraction_spinbox.setSingleStep(0.1)
+        advanced_options_form_layout.addRow("Minimum mask fraction", self.minimum_mask_fraction_spinbox)
+
+        # Output directory (empty to add the patches as a layer)
+        self.output_directory_lineedit = QLineEdit(parent=self)
+        self.output_directory_lineedit.setPlaceholderText("Add as a layer")
+        advanced_options_form_layout.addRow("Output directory", self.output_directory_lineedit)
+
+        # Add extract button
+        extract_button = QPushButton("Extract patches")
+        extract_button.clicked.connect(self.extract_button_clicked)
+        layout.addWidget(extract_button)
+
+        self.initialize_lists()
+
+    def initialize_lists(self):
+        """Updates the UI of the widget based on viewer data"""
+        layers = self.viewer.layers
+        for layer in layers:
+            if isinstance(layer, Image):
+                update_layer_combobox(self.image_combobox, "inserted", layer, layer.name)
+            elif isinstance(layer, Shapes):
+                update_layer_combobox(self.shape_combobox, "inserted", layer, layer.name)
+            else:
+                pass
+
+    def update_lists(self, event: Event):
+        """Updates the layer lists"""
+        value = event.value
+        if isinstance(event.value, Image):
+            update_layer_combobox(self.image_combobox, event.type, value, value.name)
+        elif isinstance(event.value, Shapes):
+            update_layer_combobox(self.shape_combobox, event.type, value, value.name)
+        else:
+            pass
+
+    def extract_button_clicked(self):
+        """Start patch extraction"""
+
+        # Get settings from UI
+        image_layer: Image = self.image_combobox.currentData()
+        shape_layer: Shapes = self.shape_combobox.currentData()
+        patch_size = self.patch_size_spinbox.value()
+        overlap = self.overlap_spinbox.value()
+        minimum_mask_fraction = self.minimum_mask_fraction_spinbox.value()
+        output_directory = self.output_directory_lineedit.text().strip()
+
+        # Stopping condition 1
+        if image_layer is None:
+            warnings.warn("Please select an image to use")
+            return
+
+        # Retrive data used
+        image_data = image_layer.data
+        if not isinstance(image_data, da.Array):
+            image_data = da.from_array(image_data)
+        is_rgb = image_layer.rgb
+        ndim = image_data.ndim
+        if is_rgb:
+            ndim = ndim - 1
+
+        # Stopping condition 2
+        if shape_layer is None:
+            shape_layer = self.viewer.add_shapes(data=None, ndim=ndim)
+            shape_layer.mode = "add_rectangle"
+            shape_layer.name = "patch regions"
+            warnings.warn("Please draw the regions to tile")
+            return
+
+        # Stopping condition 3
+        if len(shape_layer.data) == 0:
+            warnings.warn("no shapes in the selected shapes layer")
+            return
+
+        # Attempt to figure out the dimensions of indices
+        dimension_indicies = core.infer_demension_indicies(len(image_data.shape), 2, is_rgb)
+
+        # Regions are the selected shapes (all shapes if none are selected)
+        image_size = core.image_size(image_data, is_rgb=is_rgb)
+        masks = shape_layer.to_masks(mask_shape=image_size)
+        selected_shapes = sorted(shape_layer.selected_data)
+        if len(selected_shapes) > 0:
+            masks = masks[selected_shapes]
+
+        # Begin tiling
+        patches, origins = core.tile_patches(
+            image=image_data,
+            masks=masks,
+            patch_size=(patch_size, patch_size),
+            dimension_indicies=dimension_indicies,
+            overlap=overlap,
+            minimum_mask_fraction=minimum_mask_fraction,
+        )
+
+        # Stopping condition 4
+        if len(origins) == 0:
+            warnings.warn("no patches fit in the selected regions")
+            return
+
+        # Save or add layer
+        if output_directory:
+            core.save_patches(patches, origins, output_directory)
+        else:
+            self.viewer.add_image(
+                patches,
+                name=image_layer.name + "(patches)",
+                rgb=is_rgb,
+                contrast_limits=image_layer.contrast_limits,
+            )
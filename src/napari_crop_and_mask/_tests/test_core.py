@@ -0,0 +1,281 @@
+import gc
+
+import dask.array as da
+import numpy as np
+import pytest
+
+from napari_crop_and_mask import core
+from napari_crop_and_mask.models import CropStrategy, ExecutionMode, MaskLayout
+
+
+def test_valid_bounding_box():
+    mask = np.zeros((20, 30), dtype=bool)
+    mask[5:8, 10:25] = True
+    dimension_min, dimension_max = core.valid_bounding_box(da.from_array(mask, chunks=(5, 5)))
+
+    np.testing.assert_array_equal(dimension_min, [5, 10])
+    np.testing.assert_array_equal(dimension_max, [8, 25])
+
+
+def test_valid_bounding_box_empty():
+    mask = da.zeros((10, 10), dtype=bool, chunks=5)
+    dimension_min, dimension_max = core.valid_bounding_box(mask)
+
+    np.testing.assert_array_equal(dimension_min, dimension_max)
+
+
+def test_mask_irregular_trim():
+    image = da.from_array(np.arange(3 * 20 * 30, dtype=float).reshape((3, 20, 30)), chunks=(1, 10, 10))
+    mask = np.zeros((20, 30), dtype=bool)
+    mask[2:6, 12:15] = True
+
+    trimmed_image, translation = core.mask_irregular(
+        image, masks=(mask,), dimension_indicies=(1, 2), mask_value=0, is_trim=True
+    )
+
+    assert trimmed_image.shape == (3, 4, 3)
+    np.testing.assert_array_equal(translation, [0, 2, 12])
+    np.testing.assert_array_equal(trimmed_image.compute(), image[:, 2:6, 12:15].compute())
+
+
+def test_crop_exclude_hyperrectangle():
+    image = da.ones((10, 10), chunks=5)
+
+    # Excluding the full first rows leaves the rest of the image
+    cropped_image, translation = core.crop_mask_hyperrectangle(
+        image,
+        dimension_min=(0, 0),
+        dimension_max=(3, 9),
+        is_invert_selection=True,
+        is_trim=True,
+    )
+
+    assert cropped_image.shape == (6, 10)
+    np.testing.assert_array_equal(translation, [4, 0])
+    assert not np.isnan(cropped_image.compute()).any()
+
+    # Without trimming the image keeps its shape (and registration)
+    cropped_image = core.crop_mask_hyperrectangle(
+        image,
+        dimension_min=(0, 0),
+        dimension_max=(3, 9),
+        is_invert_selection=True,
+    )
+
+    assert cropped_image.shape == (10, 10)
+    assert np.isnan(cropped_image[:4].compute()).all()
+
+
+def test_multiscale_pyramid():
+    image = da.from_array(np.arange(100 * 60, dtype=np.uint16).reshape((100, 60)), chunks=(25, 25))
+    levels = core.multiscale_pyramid(image, downscale_factor=2, minimum_size=20)
+
+    assert [level.shape for level in levels] == [(100, 60), (50, 30), (25, 15), (12, 7)]
+    assert all(level.dtype == image.dtype for level in levels)
+
+    # Cached levels give the same result when computed again
+    expected = image[:2, :2].compute().mean().astype(np.uint16)
+    assert levels[1][0, 0].compute() == expected
+    assert levels[1][0, 0].compute() == expected
+
+
+def test_choose_execution_mode(tmp_path):
+    assert core.choose_execution_mode(100, memory_budget=1000) == ExecutionMode.PERSIST
+    assert core.choose_execution_mode(10000, memory_budget=1000, cache_directory=tmp_path) == ExecutionMode.DISK_CACHE
+
+
+def test_execute_image_disk_cache(tmp_path):
+    image = da.arange(1000, chunks=100).reshape((10, 100)) * 2
+    cached_image = core.execute_image(image, ExecutionMode.DISK_CACHE, cache_directory=tmp_path)
+
+    assert len(list(tmp_path.glob("*.npy"))) == 1
+    np.testing.assert_array_equal(cached_image.compute(), image.compute())
+
+    # The cache file goes away with the array
+    del cached_image
+    gc.collect()
+    assert len(list(tmp_path.glob("*.npy"))) == 0
+
+
+def test_chained_operations_keep_graph_size():
+    data = np.arange(60 * 80, dtype=float).reshape((60, 80))
+    image = da.from_array(data, chunks=(20, 20))
+
+    result = core.crop_hyperrectangle(image, (5, 5), (55, 75))
+    result = core.mask_hyperrectangle(result, (0, 0), (40, 60), mask_value=0)
+    graph_size = len(result.__dask_graph__().layers)
+
+    expected = data[5:55, 5:75].copy()
+    expected[41:, :] = 0
+    expected[:, 61:] = 0
+    for _ in range(5):
+        result = core.crop_hyperrectangle(result, (1, 1), (result.shape[0] - 1, result.shape[1] - 1))
+        result = core.mask_hyperrectangle(result, (0, 0), (30, 50), mask_value=0)
+
+        expected = expected[1:-1, 1:-1].copy()
+        expected[31:, :] = 0
+        expected[:, 51:] = 0
+
+    assert len(result.__dask_graph__().layers) == graph_size
+    np.testing.assert_array_equal(result.compute(), expected)
+
+
+def test_patch_origins():
+    mask = np.zeros((20, 20), dtype=bool)
+    mask[0:10, 0:10] = True
+    mask[10:15, 0:3] = True
+
+    # Patches outside the mask are never kept
+    origins = core.patch_origins(mask, patch_size=(5, 5))
+    assert len(origins) == 5
+
+    origins = core.patch_origins(mask, patch_size=(5, 5), minimum_mask_fraction=1)
+    assert len(origins) == 4
+
+
+def test_tile_patches(tmp_path):
+    data = np.arange(2 * 30 * 40, dtype=float).reshape((2, 30, 40))
+    image = da.from_array(data, chunks=(1, 10, 10))
+    mask = np.zeros((30, 40), dtype=bool)
+    mask[4:20, 8:32] = True
+
+    patches, origins = core.tile_patches(
+        image, masks=(mask,), patch_size=(8, 8), dimension_indicies=(1, 2), overlap=4, batch_size=4
+    )
+
+    assert patches.shape == (len(origins), 2, 8, 8)
+    assert max(patches.chunks[0]) <= 4
+
+    # Each batch stays within one image chunk
+    batch_starts = np.cumsum((0,) + patches.chunks[0])
+    for start, stop in zip(batch_starts[:-1], batch_starts[1:]):
+        assert len(np.unique(origins[start:stop] // 10, axis=0)) == 1
+
+    for patch, (y, x) in zip(patches.compute(), origins):
+        np.testing.assert_array_equal(patch, data[:, y : y + 8, x : x + 8])
+
+    core.save_patches(patches, origins, tmp_path)
+    np.testing.assert_array_equal(np.load(tmp_path / "origins.npy"), origins)
+    np.testing.assert_array_equal(da.from_npy_stack(tmp_path).compute(), patches.compute())
+
+
+def test_plan_operation():
+    image = da.zeros((100, 100), dtype=np.uint8, chunks=(10, 10))
+
+    # Cropping reads only the intersecting chunks
+    plan = core.plan_operation(image, (5, 5), (25, 15))
+    assert plan.strategy == CropStrategy.SLICE
+    assert plan.bytes_read == 30 * 20
+    assert plan.bytes_produced == 20 * 10
+    assert plan.rasterization_cost == 0
+
+    # Irregular masks rasterize every shape over the whole image
+    plan = core.plan_operation(image, (5, 5), (25, 15), is_mask_only=True, n_shapes=3)
+    assert plan.strategy == CropStrategy.MASK
+    assert plan.mask_layout == MaskLayout.PER_BLOCK
+    assert plan.bytes_produced == 100 * 100 * 8
+    assert plan.rasterization_cost == 3 * 100 * 100
+
+    # The selected execution mode is kept, persisting counts in the peak memory
+    plan = core.plan_operation(image, (5, 5), (25, 15), execution_mode=ExecutionMode.PERSIST, memory_budget=10)
+    assert plan.execution_mode == ExecutionMode.PERSIST
+    assert plan.peak_memory == 20 * 10
+    plan = core.plan_operation(image, (5, 5), (25, 15), execution_mode=ExecutionMode.LAZY)
+    assert plan.execution_mode == ExecutionMode.LAZY
+    assert plan.peak_memory == 0
+
+
+def test_mask_trim_as_slice():
+    data = np.arange(30 * 40, dtype=float).reshape((30, 40))
+    image = da.from_array(data, chunks=(10, 10))
+
+    trimmed_image, translation = core.crop_mask_hyperrectangle(
+        image, (5, 8), (14, 20), is_mask_only=True, mask_value=0, is_trim=True
+    )
+
+    np.testing.assert_array_equal(translation, [5, 8])
+    np.testing.assert_array_equal(trimmed_image.compute(), data[5:15, 8:21])
+
+
+def test_multiscale_pyramid_masked():
+    data = np.ones((64, 64))
+    data[:, ::2] = np.nan
+    levels = core.multiscale_pyramid(da.from_array(data, chunks=16), minimum_size=8, cache_bytes=4 * 8 * 8 * 8)
+
+    # Masked pixels do not spread to coarser levels
+    assert not np.isnan(levels[-1].compute()).any()
+
+
+def test_block_cache_size():
+    cache = core.BlockCache(max_bytes=3 * 80)
+    for i in range(5):
+        cache.put(i, np.zeros(10))
+
+    assert cache.n_bytes <= 3 * 80
+    assert cache.get(0) is None
+    assert cache.get(4) is not None
+
+
+def test_persisted_result_is_a_source():
+    data = np.arange(60 * 80, dtype=float).reshape((60, 80))
+    image = da.from_array(data, chunks=(20, 20))
+
+    result = core.mask_hyperrectangle(image, (0, 0), (40, 60), mask_value=0)
+    result = core.execute_image(result, ExecutionMode.PERSIST)
+    result = core.crop_hyperrectangle(result, (5, 5), (30, 50))
+
+    assert image.name not in result.__dask_graph__().layers
+    np.testing.assert_array_equal(result.compute(), data[5:30, 5:50])
+
+
+def test_provenance_released_with_result():
+    image = da.zeros((10, 10), chunks=5)
+    result = core.crop_hyperrectangle(image, (2, 2), (8, 8))
+    n_provenances = len(core._PROVENANCES)
+
+    del result
+    gc.collect()
+    assert len(core._PROVENANCES) == n_provenances - 1
+
+
+def test_available_memory():
+    memory = core.available_memory()
+    assert memory is None or memory > 0
+
+
+def test_edited_result_is_a_source():
+    image = da.zeros((10, 10), chunks=5)
+    result = core.crop_hyperrectangle(image, (2, 2), (8, 8))
+    result[0, 0] = 7
+    result = core.crop_hyperrectangle(result, (0, 0), (3, 3))
+
+    assert result[0, 0].compute() == 7
+
+
+def test_rectangle_masks_stay_small():
+    image = da.ones((3, 20000, 20000), dtype=np.uint8, chunks=(1, 2000, 2000))
+    result = core.mask_hyperrectangle(image, (0, 100, 100), (0, 15000, 15000), dimension_indicies=(1, 2), mask_value=0)
+    result = core.mask_hyperrectangle(result, (0, 50, 50), (0, 10000, 10000), dimension_indicies=(1, 2), mask_value=0)
+
+    # Chained rectangles are kept as a single selection per dimension
+    masks = core._get_provenance(result).masks
+    assert len(masks) == 1
+    assert sum(selection.nbytes for selection in masks[0].selections if selection is not None) == 2 * 20000
+    assert result[0, 99:101, 10000:10002].compute().tolist() == [[0, 0], [1, 0]]
+
+
+def test_planned_strategy_is_used():
+    data = np.arange(30 * 40, dtype=float).reshape((30, 40))
+    image = da.from_array(data, chunks=(10, 10))
+    plan = core.plan_operation(image, (5, 8), (14, 20), is_mask_only=True, mask_value=0, is_trim=True)
+    assert plan.strategy == core.choose_crop_strategy(True, True, False, True) == CropStrategy.SLICE
+
+    # A mask gives the same trimmed result as the planned slice
+    trimmed_image, translation = core.crop_mask_hyperrectangle(
+        image, (5, 8), (14, 20), is_mask_only=True, mask_value=0, is_trim=True, strategy=CropStrategy.MASK
+    )
+    np.testing.assert_array_equal(translation, [5, 8])
+    np.testing.assert_array_equal(trimmed_image.compute(), data[5:15, 8:21])
+
+    with pytest.raises(ValueError):
+        core.crop_mask_hyperrectangle(image, (5, 8), (14, 20), is_invert_selection=True, strategy=CropStrategy.SLICE)
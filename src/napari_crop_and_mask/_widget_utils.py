@@ -1,9 +1,14 @@
 """Widget Utilites"""
-from typing import Any
+from typing import Any, Callable
 
+import dask.array as da
 from napari.layers.base.base import Layer
+from napari.qt.threading import create_worker
 from napari.utils.events.event import Event
-from qtpy.QtWidgets import QComboBox
+from qtpy.QtWidgets import QComboBox, QLabel, QMessageBox, QWidget
+
+from napari_crop_and_mask.core import available_memory, execute_image
+from napari_crop_and_mask.models import ExecutionMode, OperationPlan, Scheduler, format_bytes
 
 
 def get_combobox_item_index(combobox: QComboBox, item_data: Any) -> list[int]:
@@ -32,3 +37,44 @@ def update_layer_combobox(combobox: QComboBox, event_type: str, layer: Layer, te
             combobox.removeItem(item_index)
     else:
         pass
+
+
+def confirm_plan(plan: OperationPlan, label: QLabel, parent: QWidget) -> bool:
+    """Shows the estimate of an operation and asks for confirmation if it exceeds the available memory"""
+    label.setText(str(plan))
+    memory = available_memory()
+    if memory is None or plan.peak_memory <= memory:
+        return True
+
+    answer = QMessageBox.question(
+        parent,
+        "Not enough memory",
+        f"The operation may need {format_bytes(plan.peak_memory)} "
+        + f"but only {format_bytes(memory)} is available. Continue anyway?",
+    )
+    return answer == QMessageBox.Yes
+
+
+def execute_in_background(
+    image: da.Array,
+    on_executed: Callable[[da.Array], Any],
+    execution_mode: ExecutionMode,
+    memory_budget: float,
+    scheduler: Scheduler,
+):
+    """
+    Executes an image in a worker thread (keeping the ui responsive) and passes the result to
+    on_executed in the main thread. Lazy images are passed directly
+    """
+    if execution_mode == ExecutionMode.LAZY:
+        on_executed(image)
+        return None
+
+    return create_worker(
+        execute_image,
+        image,
+        execution_mode=execution_mode,
+        memory_budget=memory_budget,
+        scheduler=scheduler,
+        _connect={"returned": on_executed},
+    )
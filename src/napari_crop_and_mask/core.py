@@ -1,9 +1,21 @@
 """Cropping image processing"""
 import copy
-from typing import Any, Iterable, Optional, Sequence, Tuple
+import functools
+import itertools
+import os
+import shutil
+import tempfile
+import threading
+import warnings
+import weakref
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
 
 import dask.array as da
 import numpy as np
+from dask import delayed
+
+from napari_crop_and_mask.models import CropStrategy, ExecutionMode, MaskLayout, OperationPlan, Scheduler
 
 
 def combine_masks(masks: tuple) -> da.Array:
@@ -43,24 +55,35 @@ def mask_irregular(
     dimension_indicies: Optional[Iterable] = None,
     mask_value: Any = np.nan,
     is_invert_selection: bool = False,
-) -> da.Array:
-    """Masks image using the provided masks"""
+    is_trim: bool = False,
+    mask_layout: Optional[MaskLayout] = None,
+) -> Union[da.Array, Tuple[da.Array, np.ndarray]]:
+    """
+    Masks image using the provided masks. If is_trim, the output is trimmed to the extent of
+    the unmasked pixels and returned with its translation. The mask layout is chosen if not given
+    """
 
     # Dimension indices
     if dimension_indicies is None:
         dimension_indicies = np.arange(image.ndim)
 
-    mask = combine_masks(masks)
+    # Shape masks are small compared to the image, keep them in memory
+    mask = np.asarray(combine_masks(masks), dtype=bool)
+    if is_invert_selection is True:
+        mask = np.logical_not(mask)
 
-    # Expand dimensions if needed
+    # Expand dimensions if needed (broadcasted when masking)
     all_dimensions = np.arange(image.ndim)
     new_dimensions_selected = [dim not in dimension_indicies for dim in all_dimensions]
     new_dimensions = tuple(all_dimensions[new_dimensions_selected])
-    mask = da.expand_dims(mask, axis=new_dimensions)
-    mask = da.broadcast_to(mask, shape=image.shape)
+    mask = np.expand_dims(mask, axis=new_dimensions)
 
     # Mask the image based on selection
-    masked_image = mask_image(image, mask=mask, mask_value=mask_value, is_invert_selection=is_invert_selection)
+    masked_image = _mask_valid(image, _DenseMask(mask), mask_value, mask_layout)
+
+    if is_trim is True:
+        return _trim_masked(masked_image)
+
     return masked_image
 
 
@@ -75,15 +98,20 @@ def crop_hyperrectangle(
     if dimension_indicies is None:
         dimension_indicies = range(len(dimension_min))
 
+    # Crops of earlier results are applied directly to their source
+    provenance = _get_provenance(image)
+    region = list(provenance.region)
+    valid_region = [slice(None)] * image.ndim
+
     # Cropping
-    cropped_image = image
     for dimension in dimension_indicies:
-        indicies = np.arange(dimension_min[dimension], dimension_max[dimension])
-        indicies_selected = np.logical_and(indicies >= 0, indicies < image.shape[dimension])
-        indicies = indicies[indicies_selected]
+        start = int(np.clip(dimension_min[dimension], 0, image.shape[dimension]))
+        stop = int(np.clip(dimension_max[dimension], start, image.shape[dimension]))
+        region[dimension] = slice(region[dimension].start + start, region[dimension].start + stop)
+        valid_region[dimension] = slice(start, stop)
 
-        # Apply the crop in the specific dimension
-        cropped_image = da.take(cropped_image, indices=indicies, axis=dimension)
+    masks = tuple(mask.crop(tuple(valid_region)) for mask in provenance.masks)
+    cropped_image = _build(provenance._replace(region=tuple(region), masks=masks))
     return cropped_image
 
 
@@ -94,33 +122,283 @@ def mask_hyperrectangle(
     dimension_indicies: Optional[Iterable] = None,
     mask_value: Any = np.nan,
     is_invert_selection: bool = False,
-) -> da.Array:
-    """Simple rectangle masking"""
+    is_trim: bool = False,
+    mask_layout: Optional[MaskLayout] = None,
+) -> Union[da.Array, Tuple[da.Array, np.ndarray]]:
+    """
+    Simple rectangle masking. If is_trim, the output is trimmed to the extent of the unmasked
+    pixels and returned with its translation. The mask layout is chosen if not given
+    """
 
     # Dimension indices
     if dimension_indicies is None:
         dimension_indicies = range(len(dimension_min))
 
-    image_shape = image.shape
-    meshed_grids = meshgrid_from_size(image_shape)
-    mask = da.ones_like(image, dtype=bool)
+    # Create the mask, one selection per dimension (combined block by block)
+    selections: List[Optional[np.ndarray]] = [None] * image.ndim
+    for dimension in dimension_indicies:
+        indicies = np.arange(image.shape[dimension])
+        selections[dimension] = np.logical_and(
+            indicies >= dimension_min[dimension],
+            indicies <= dimension_max[dimension],
+        )
+    mask = _RectangleMask(tuple(selections), is_invert_selection)
+
+    # Mask the image based on selection
+    masked_image = _mask_valid(image, mask, mask_value, mask_layout)
+
+    if is_trim is True:
+        return _trim_masked(masked_image)
+
+    return masked_image
 
-    print(image_shape, dimension_indicies, dimension_min, dimension_max)
 
-    # Create the mask
-    for i, dimension in enumerate(dimension_indicies):
-        current_selection = da.logical_and(
-            meshed_grids[dimension] >= dimension_min[i],
-            meshed_grids[dimension] <= dimension_max[i],
+class _RectangleMask(NamedTuple):
+    """A (possibly inverted) rectangle mask, kept as one selection per dimension (None for all)"""
+
+    selections: Tuple[Optional[np.ndarray], ...]
+    is_invert: bool = False
+
+    def masked_dimensions(self) -> List[int]:
+        """Returns the dimensions the mask depends on"""
+        return [dimension for dimension, selection in enumerate(self.selections) if selection is not None]
+
+    def crop(self, region: Tuple[slice, ...]) -> "_RectangleMask":
+        """Returns the mask cropped to a region"""
+        selections = tuple(
+            None if selection is None else selection[region[dimension]]
+            for dimension, selection in enumerate(self.selections)
         )
-        mask = da.logical_and(mask, current_selection)
+        return self._replace(selections=selections)
+
+    def evaluate(self, region: Tuple[slice, ...]) -> np.ndarray:
+        """Returns the (broadcastable) valid pixels of a region"""
+        valid = np.ones((1,) * len(self.selections), dtype=bool)
+        for dimension in self.masked_dimensions():
+            selection_shape = [1] * len(self.selections)
+            selection = self.selections[dimension][region[dimension]]
+            selection_shape[dimension] = selection.size
+            valid = np.logical_and(valid, selection.reshape(selection_shape))
+        if self.is_invert is True:
+            valid = np.logical_not(valid)
+        return valid
+
+
+class _DenseMask(NamedTuple):
+    """A mask kept as a (broadcastable) array of valid pixels"""
+
+    valid: np.ndarray
+
+    def masked_dimensions(self) -> List[int]:
+        """Returns the dimensions the mask depends on"""
+        return [dimension for dimension, size in enumerate(self.valid.shape) if size > 1]
+
+    def crop(self, region: Tuple[slice, ...]) -> "_DenseMask":
+        """Returns the mask cropped to a region"""
+        return _DenseMask(self.evaluate(region))
+
+    def evaluate(self, region: Tuple[slice, ...]) -> np.ndarray:
+        """Returns the (broadcastable) valid pixels of a region"""
+        index = tuple(slice(None) if size == 1 else region[i] for i, size in enumerate(self.valid.shape))
+        return self.valid[index]
+
+
+_Mask = Union[_RectangleMask, _DenseMask]
+
+
+class _Provenance(NamedTuple):
+    """
+    How an array produced by this module is computed from its source: the source is cropped to
+    the region and the pixels outside any of the masks are set to the mask value
+    """
+
+    source: da.Array
+    region: Tuple[slice, ...]
+    masks: Tuple[_Mask, ...] = ()
+    mask_value: Any = None
+    name: Optional[str] = None
+
+
+# Provenance of the results, by object id. An entry lives as long as its result (which already
+# references the source and mask in its graph). Arrays derived in other ways (persisted, cached on
+# disk) are new objects, so they are used as sources. Results edited in place (setitem) get a new
+# dask name, which no longer matches the name of their provenance
+_PROVENANCES: Dict[int, _Provenance] = {}
+
+
+def _get_provenance(image: da.Array) -> _Provenance:
+    """Returns the provenance of an earlier result, or the image itself as a source"""
+    provenance = _PROVENANCES.get(id(image))
+    if provenance is None or provenance.name != image.name:
+        provenance = _Provenance(source=image, region=tuple(slice(0, size) for size in image.shape))
+    return provenance
+
+
+def _build(provenance: _Provenance, mask_layout: Optional[MaskLayout] = None) -> da.Array:
+    """Builds a (flat) graph from the source of a provenance and remembers it"""
+    image = provenance.source[provenance.region]
+    if len(provenance.masks) > 0:
+        if mask_layout is None:
+            mask_size = int(np.prod([image.shape[dimension] for dimension in _masked_dimensions(provenance.masks)]))
+            mask_layout = choose_mask_layout(mask_size, image)
+        valid = _mask_array(provenance.masks, image, mask_layout == MaskLayout.PER_BLOCK)
+        image = mask_image(image, mask=valid, mask_value=provenance.mask_value)
+
+    # The source itself (whole region, no mask) is not a result
+    if image is not provenance.source:
+        _PROVENANCES[id(image)] = provenance._replace(name=image.name)
+        weakref.finalize(image, _PROVENANCES.pop, id(image), None)
+
+    return image
 
-    # Mask the image based on selection
-    masked_image = mask_image(image, mask=mask, mask_value=mask_value, is_invert_selection=is_invert_selection)
 
+def _masked_dimensions(masks: Sequence[_Mask]) -> List[int]:
+    """Returns the dimensions any of the masks depends on"""
+    return sorted(set(dimension for mask in masks for dimension in mask.masked_dimensions()))
+
+
+def _evaluate_masks(masks: Sequence[_Mask], block_info=None) -> np.ndarray:
+    """Returns the valid pixels of a block (for map_blocks)"""
+    region = tuple(slice(start, stop) for start, stop in block_info[None]["array-location"])
+    valid = np.ones((1,) * len(region), dtype=bool)
+    for mask in masks:
+        valid = np.logical_and(valid, mask.evaluate(region))
+    return np.broadcast_to(valid, block_info[None]["chunk-shape"])
+
+
+def _mask_array(masks: Sequence[_Mask], image: da.Array, is_per_block: bool = True) -> da.Array:
+    """
+    Returns the lazy valid pixels of an image, evaluated block by block (or in a single block)
+    over the masked dimensions and broadcasted over the others
+    """
+    masked_dimensions = _masked_dimensions(masks)
+    if is_per_block is True:
+        chunks = tuple(image.chunks[i] if i in masked_dimensions else (1,) for i in range(image.ndim))
+    else:
+        chunks = tuple((image.shape[i],) if i in masked_dimensions else (1,) for i in range(image.ndim))
+
+    valid = da.map_blocks(
+        functools.partial(_evaluate_masks, tuple(masks)),
+        chunks=chunks,
+        dtype=bool,
+        meta=np.empty((0,) * image.ndim, dtype=bool),
+    )
+    if is_per_block is True:
+        return da.broadcast_to(valid, image.shape, chunks=image.chunks)
+    return da.broadcast_to(valid, image.shape)
+
+
+def _is_same_mask_value(first: Any, second: Any) -> bool:
+    """Returns a boolean if the mask values are the same (nan included)"""
+    if first is None or second is None:
+        return first is second
+    return bool(first == second or (np.isnan(first) and np.isnan(second)))
+
+
+def _combine_masks(first: _Mask, second: _Mask) -> Optional[_Mask]:
+    """Returns a single mask equivalent to two masks, if there is a simple one"""
+    if isinstance(first, _DenseMask) and isinstance(second, _DenseMask):
+        return _DenseMask(np.logical_and(first.valid, second.valid))
+
+    # Rectangles (not inverted) are combined dimension by dimension
+    if isinstance(first, _RectangleMask) and isinstance(second, _RectangleMask):
+        if first.is_invert is False and second.is_invert is False:
+            selections = tuple(
+                second_selection
+                if first_selection is None
+                else first_selection
+                if second_selection is None
+                else np.logical_and(first_selection, second_selection)
+                for first_selection, second_selection in zip(first.selections, second.selections)
+            )
+            return _RectangleMask(selections)
+
+    return None
+
+
+def _mask_valid(image: da.Array, mask: _Mask, mask_value: Any, mask_layout: Optional[MaskLayout] = None) -> da.Array:
+    """Masks the pixels outside a mask, combined with the masks of an earlier result if possible"""
+    provenance = _get_provenance(image)
+    masks = provenance.masks
+    if len(masks) > 0 and not _is_same_mask_value(provenance.mask_value, mask_value):
+        provenance = _Provenance(source=image, region=tuple(slice(0, size) for size in image.shape))
+        masks = ()
+
+    # Merge with the latest mask if possible
+    combined_mask = None if len(masks) == 0 else _combine_masks(masks[-1], mask)
+    if combined_mask is None:
+        masks = masks + (mask,)
+    else:
+        masks = masks[:-1] + (combined_mask,)
+
+    masked_image = _build(provenance._replace(masks=masks, mask_value=mask_value), mask_layout)
     return masked_image
 
 
+def _trim_masked(masked_image: da.Array) -> Tuple[da.Array, np.ndarray]:
+    """Trims a masked result to the extent of its (combined) masks"""
+    masks = _get_provenance(masked_image).masks
+    masked_dimensions = _masked_dimensions(masks)
+
+    # Valid pixels over the masked dimensions only, reduced block by block
+    valid = _mask_array(masks, masked_image, is_per_block=True)
+    valid = valid[tuple(slice(None) if i in masked_dimensions else 0 for i in range(masked_image.ndim))]
+    return trim_to_valid(masked_image, valid, masked_dimensions)
+
+
+def valid_bounding_box(mask: da.Array) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the dimension minimum and (exclusive) maximum of the True values in a mask. Each
+    dimension is reduced chunk by chunk, so only the 1D projections are gathered. An empty box
+    (min == max == 0) is returned if the mask has no True values
+    """
+    mask = da.asarray(mask).astype(bool)
+    all_dimensions = tuple(range(mask.ndim))
+
+    # Project the mask on each dimension
+    projections = [
+        da.any(mask, axis=tuple(other for other in all_dimensions if other != dimension))
+        for dimension in all_dimensions
+    ]
+    projections = da.compute(*projections)
+
+    dimension_min = np.zeros(mask.ndim, dtype=int)
+    dimension_max = np.zeros(mask.ndim, dtype=int)
+    for dimension, projection in enumerate(projections):
+        valid_indicies = np.flatnonzero(projection)
+        if valid_indicies.size == 0:
+            return (np.zeros(mask.ndim, dtype=int), np.zeros(mask.ndim, dtype=int))
+        dimension_min[dimension] = valid_indicies[0]
+        dimension_max[dimension] = valid_indicies[-1] + 1
+
+    return (dimension_min, dimension_max)
+
+
+def trim_to_valid(
+    image: da.Array,
+    valid_mask: da.Array,
+    dimension_indicies: Optional[Iterable[int]] = None,
+) -> Tuple[da.Array, np.ndarray]:
+    """
+    Trims an image to the bounding box of a mask of valid pixels. The mask spans the given image
+    dimensions (all dimensions by default). Returns the trimmed image and its translation
+    """
+    if dimension_indicies is None:
+        dimension_indicies = range(image.ndim)
+    dimension_indicies = list(dimension_indicies)
+
+    mask_min, mask_max = valid_bounding_box(valid_mask)
+
+    # Other dimensions are kept as they are
+    dimension_min = np.zeros(image.ndim, dtype=int)
+    dimension_max = np.array(image.shape, dtype=int)
+    dimension_min[dimension_indicies] = mask_min
+    dimension_max[dimension_indicies] = mask_max
+
+    trimmed_image = crop_hyperrectangle(image, dimension_min, dimension_max, dimension_indicies)
+    return (trimmed_image, dimension_min)
+
+
 def infer_demension_indicies(n_dimensions_image: int, n_dimensions_indicies: int = 2, is_rgb: bool = False):
     """
     Try to infer the dimensions to crop based on the image shape and the number of dimensions to
@@ -184,13 +462,30 @@ def crop_mask_hyperrectangle(
     is_mask_only: bool = False,
     mask_value=np.nan,
     is_invert_selection: bool = False,
-) -> da.Array:
-    """Crops an image given the function"""
+    is_trim: bool = False,
+    strategy: Optional[CropStrategy] = None,
+    mask_layout: Optional[MaskLayout] = None,
+) -> Union[da.Array, Tuple[da.Array, np.ndarray]]:
+    """
+    Crops an image given the function. If is_trim, the output is trimmed to the extent of the
+    unmasked pixels and returned with its translation. The strategy and mask layout (e.g. from
+    plan_operation) are chosen if not given
+    """
 
     # Attempt automatic detection of dimensions if needed
     if dimension_indicies is None:
         dimension_indicies = list(range(0, len(dimension_min)))
 
+    if strategy is None:
+        strategy = choose_crop_strategy(True, is_mask_only, is_invert_selection, is_trim)
+    if strategy == CropStrategy.SLICE and is_invert_selection is True:
+        raise ValueError("Cropping out a rectangle cannot be done with a slice")
+
+    # Keeping a rectangle and trimming it is a crop (with the inclusive mask maximum)
+    if strategy == CropStrategy.SLICE and is_mask_only is True:
+        is_mask_only = False
+        dimension_max = np.asarray(dimension_max) + 1
+
     # Just crop
     if is_mask_only is False and is_invert_selection is False:
         cropped_image = crop_hyperrectangle(
@@ -200,6 +495,13 @@ def crop_mask_hyperrectangle(
             dimension_indicies,
         )
 
+        # The crop is already tight, only the translation is needed
+        if is_trim is True:
+            translation = np.zeros(image.ndim, dtype=int)
+            for dimension in dimension_indicies:
+                translation[dimension] = max(dimension_min[dimension], 0)
+            return (cropped_image, translation)
+
     # masked cropping
     if is_mask_only is True:
         cropped_image = mask_hyperrectangle(
@@ -209,6 +511,505 @@ def crop_mask_hyperrectangle(
             dimension_indicies,
             mask_value=mask_value,
             is_invert_selection=is_invert_selection,
+            is_trim=is_trim,
+            mask_layout=mask_layout,
+        )
+
+    # Cropping out a rectangle, mask it (and keep the extent of what is left if trimming)
+    if is_mask_only is False and is_invert_selection is True:
+        if mask_value is None:
+            mask_value = np.nan
+        cropped_image = mask_hyperrectangle(
+            image,
+            dimension_min,
+            dimension_max,
+            dimension_indicies,
+            mask_value=mask_value,
+            is_invert_selection=is_invert_selection,
+            is_trim=is_trim,
+            mask_layout=mask_layout,
         )
 
     return cropped_image
+
+
+def downsample_image(
+    image: da.Array,
+    downscale_factor: int = 2,
+    dimension_indicies: Optional[Iterable[int]] = None,
+) -> da.Array:
+    """Downsamples the given dimensions of an image by block-wise averaging"""
+    if dimension_indicies is None:
+        dimension_indicies = range(image.ndim)
+    dimension_indicies = list(dimension_indicies)
+
+    # Drop the excess at the end and align chunks with the factor so each block is reduced on its own
+    excess_trimmed = tuple(
+        slice(0, (size // downscale_factor) * downscale_factor) if dimension in dimension_indicies else slice(None)
+        for dimension, size in enumerate(image.shape)
+    )
+    image = image[excess_trimmed]
+    chunks = {
+        dimension: max(image.chunksize[dimension] // downscale_factor, 1) * downscale_factor
+        for dimension in dimension_indicies
+    }
+    image = image.rechunk(chunks)
+
+    # Masked (nan) pixels are left out of the average so holes do not grow at each level
+    reduction = _nanmean if np.issubdtype(image.dtype, np.floating) else np.mean
+    factors = {dimension: downscale_factor for dimension in dimension_indicies}
+    downsampled_image = da.coarsen(reduction, image, factors, trim_excess=True)
+    return downsampled_image.astype(image.dtype)
+
+
+def _nanmean(block: np.ndarray, axis=None) -> np.ndarray:
+    """Mean ignoring nan values, nan (without warning) where all values are nan"""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return np.nanmean(block, axis=axis)
+
+
+class BlockCache:
+    """A thread-safe least recently used cache of computed blocks, limited in bytes"""
+
+    def __init__(self, max_bytes: int = 2**28):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self._blocks: "OrderedDict[Any, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[np.ndarray]:
+        """Returns a cached block (None if missing) and marks it as recently used"""
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is not None:
+                self._blocks.move_to_end(key)
+            return block
+
+    def put(self, key, block: np.ndarray):
+        """Caches a block, dropping the least recently used ones beyond the size limit"""
+        if block.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._blocks:
+                self.n_bytes -= self._blocks.pop(key).nbytes
+            self._blocks[key] = block
+            self.n_bytes += block.nbytes
+            while self.n_bytes > self.max_bytes:
+                _, dropped_block = self._blocks.popitem(last=False)
+                self.n_bytes -= dropped_block.nbytes
+
+
+def cache_blocks(image: da.Array, cache: Optional[BlockCache] = None) -> da.Array:
+    """Returns a lazy array whose computed blocks are reused from a (size limited) cache"""
+    if cache is None:
+        cache = BlockCache()
+
+    def load_block(block_info=None):
+        key = (image.name, tuple(block_info[None]["chunk-location"]))
+        block = cache.get(key)
+        if block is None:
+            block = image.blocks[key[1]].compute(scheduler="synchronous")
+            cache.put(key, block)
+        return block
+
+    return da.map_blocks(load_block, chunks=image.chunks, dtype=image.dtype, meta=image._meta)
+
+
+def multiscale_pyramid(
+    image: da.Array,
+    dimension_indicies: Optional[Iterable[int]] = None,
+    downscale_factor: int = 2,
+    minimum_size: int = 256,
+    is_cache_levels: bool = True,
+    cache_bytes: int = 2**28,
+) -> List[da.Array]:
+    """
+    Returns a lazily computed multiscale pyramid of an image. The given dimensions are
+    downsampled until they fit in the minimum size. Each level is computed from the previous one
+    and, if is_cache_levels, its computed blocks are kept for later views in a cache shared by
+    all levels and limited to cache_bytes
+    """
+    if dimension_indicies is None:
+        dimension_indicies = range(image.ndim)
+    dimension_indicies = list(dimension_indicies)
+    cache = BlockCache(cache_bytes)
+
+    levels = [image]
+    while True:
+        level_size = [levels[-1].shape[dimension] for dimension in dimension_indicies]
+        if max(level_size) <= minimum_size or min(level_size) < downscale_factor:
+            break
+
+        level = downsample_image(levels[-1], downscale_factor, dimension_indicies)
+        if is_cache_levels is True:
+            level = cache_blocks(level, cache)
+        levels.append(level)
+
+    return levels
+
+
+class _NpyFile:
+    """
+    A picklable .npy file, written and read block by block (memory mapped) so it can be used as
+    a store target and as a lazy array source from other processes
+    """
+
+    def __init__(self, path: str, shape: Tuple[int, ...], dtype: np.dtype):
+        self.path = path
+        self.shape = shape
+        self.dtype = np.dtype(dtype)
+        self.ndim = len(shape)
+
+    def __setitem__(self, key, value):
+        target = np.load(self.path, mmap_mode="r+")
+        target[key] = value
+        target.flush()
+
+    def __getitem__(self, key) -> np.ndarray:
+        return np.array(np.load(self.path, mmap_mode="r")[key])
+
+
+def _remove_file(path: str):
+    """Removes a file if possible"""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def estimate_nbytes(image: da.Array) -> int:
+    """Returns the estimated size of an image in bytes once computed"""
+    return int(np.prod(image.shape, dtype=np.int64)) * image.dtype.itemsize
+
+
+def choose_execution_mode(
+    nbytes: int,
+    memory_budget: float,
+    cache_directory: Optional[str] = None,
+) -> ExecutionMode:
+    """Chooses an execution mode for a result of the given size"""
+    if nbytes <= memory_budget:
+        return ExecutionMode.PERSIST
+
+    # Spill to disk only if there is room for it
+    if cache_directory is None:
+        cache_directory = tempfile.gettempdir()
+    if nbytes < shutil.disk_usage(cache_directory).free:
+        return ExecutionMode.DISK_CACHE
+
+    return ExecutionMode.LAZY
+
+
+def execute_image(
+    image: da.Array,
+    execution_mode: ExecutionMode = ExecutionMode.LAZY,
+    memory_budget: float = 2e9,
+    scheduler: Scheduler = Scheduler.THREADS,
+    cache_directory: Optional[str] = None,
+) -> da.Array:
+    """
+    Executes an image graph according to the execution mode. The image is kept lazy, persisted
+    in memory or stored on a local disk cache (an .npy memory map). Automatic mode chooses one
+    based on the estimated size of the image and the memory budget (in bytes)
+    """
+    if execution_mode == ExecutionMode.AUTOMATIC:
+        execution_mode = choose_execution_mode(estimate_nbytes(image), memory_budget, cache_directory)
+
+    if execution_mode == ExecutionMode.PERSIST:
+        return image.persist(scheduler=scheduler.value)
+
+    if execution_mode == ExecutionMode.DISK_CACHE:
+        with tempfile.NamedTemporaryFile(
+            prefix="napari_crop_and_mask_", suffix=".npy", dir=cache_directory, delete=False
+        ) as cache_file:
+            cache_path = cache_file.name
+        np.lib.format.open_memmap(cache_path, mode="w+", dtype=image.dtype, shape=image.shape).flush()
+        cache_file = _NpyFile(cache_path, image.shape, image.dtype)
+        da.store(image, cache_file, lock=False, scheduler=scheduler.value)
+
+        # The cache file is removed once no graph uses it anymore (or at exit)
+        weakref.finalize(cache_file, _remove_file, cache_path)
+        return da.from_array(
+            cache_file,
+            chunks=image.chunks,
+            name="disk-cache-" + os.path.basename(cache_path),
+            meta=np.empty((0,) * image.ndim, dtype=image.dtype),
+        )
+
+    return image
+
+
+def patch_origins(
+    mask: np.ndarray,
+    patch_size: Sequence[int],
+    overlap: Union[int, Sequence[int]] = 0,
+    minimum_mask_fraction: float = 0.0,
+) -> np.ndarray:
+    """
+    Returns the origins of a grid of fixed-size patches covering the bounding box of a mask.
+    Only patches that fit in the mask, overlap it and have at least the minimum fraction of
+    their pixels inside the mask are kept
+    """
+    mask = np.asarray(mask, dtype=bool)
+    patch_size = np.asarray(patch_size, dtype=int)
+    stride = np.maximum(patch_size - np.asarray(overlap, dtype=int), 1)
+
+    # Stopping condition
+    if not mask.any() or np.any(patch_size > mask.shape):
+        return np.empty((0, mask.ndim), dtype=int)
+
+    # Patch grid over the bounding box of the mask
+    dimension_min, dimension_max = valid_bounding_box(mask)
+    grids = []
+    last_origins = np.minimum(np.maximum(dimension_min, dimension_max - patch_size), mask.shape - patch_size)
+    for dimension in range(mask.ndim):
+        first_origin = min(dimension_min[dimension], last_origins[dimension])
+        grids.append(np.arange(first_origin, last_origins[dimension] + 1, stride[dimension]))
+    origins = np.stack(np.meshgrid(*grids, indexing="ij"), axis=-1).reshape(-1, mask.ndim)
+
+    # Count the mask pixels in each patch using a summed-area table (over the grid extent only)
+    grid_min = np.array([grid[0] for grid in grids])
+    grid_max = last_origins + patch_size
+    grid_mask = mask[tuple(slice(start, stop) for start, stop in zip(grid_min, grid_max))]
+    table = np.pad(grid_mask.astype(np.int64), [(1, 0)] * mask.ndim)
+    for dimension in range(mask.ndim):
+        table = np.cumsum(table, axis=dimension)
+    counts = np.zeros(len(origins), dtype=np.int64)
+    for corner in itertools.product((0, 1), repeat=mask.ndim):
+        index = tuple((origins - grid_min + np.array(corner) * patch_size).T)
+        counts += (-1) ** (mask.ndim - sum(corner)) * table[index]
+
+    fractions = counts / np.prod(patch_size)
+    return origins[np.logical_and(counts > 0, fractions >= minimum_mask_fraction)]
+
+
+def _extract_patches(
+    region: np.ndarray,
+    origins: np.ndarray,
+    patch_size: Sequence[int],
+    dimension_indicies: Sequence[int],
+) -> np.ndarray:
+    """Extracts the patches at the given origins from an in-memory region"""
+    n_dimensions = len(dimension_indicies)
+
+    # Sliding windows over the patched dimensions, moved to the front
+    region = np.moveaxis(region, dimension_indicies, range(n_dimensions))
+    windows = np.lib.stride_tricks.sliding_window_view(region, patch_size, axis=tuple(range(n_dimensions)))
+    patches = windows[tuple(origins[:, i] for i in range(n_dimensions))]
+
+    # Put the patch dimensions back in place (after the patch axis)
+    patches = np.moveaxis(
+        patches,
+        range(patches.ndim - n_dimensions, patches.ndim),
+        [dimension + 1 for dimension in dimension_indicies],
+    )
+    return np.ascontiguousarray(patches)
+
+
+def tile_patches(
+    image: da.Array,
+    masks: Sequence[np.ndarray],
+    patch_size: Sequence[int],
+    dimension_indicies: Optional[Iterable[int]] = None,
+    overlap: Union[int, Sequence[int]] = 0,
+    minimum_mask_fraction: float = 0.0,
+    batch_size: int = 256,
+) -> Tuple[da.Array, np.ndarray]:
+    """
+    Tiles the regions of the given masks (one per region, over the given dimensions) into
+    fixed-size patches. Patches are grouped by image chunk, then cropped and extracted in
+    batches, each batch being a single task. Returns the patches stacked on a new first axis
+    and their origins
+    """
+    if dimension_indicies is None:
+        dimension_indicies = range(image.ndim)
+    dimension_indicies = list(dimension_indicies)
+    patch_size = np.asarray(patch_size, dtype=int)
+
+    # Patches of all regions (overlapping regions give the same patches once)
+    origins = [patch_origins(mask, patch_size, overlap, minimum_mask_fraction) for mask in masks]
+    origins = np.unique(np.concatenate([np.empty((0, len(dimension_indicies)), dtype=int)] + origins), axis=0)
+
+    # Group the patches by image chunk (row-major within a chunk) so that batches stay compact
+    chunk_size = np.maximum(np.array(image.chunksize)[dimension_indicies], patch_size)
+    chunk_keys = origins // chunk_size
+    order = np.lexsort(np.concatenate([chunk_keys, origins], axis=1).T[::-1])
+    origins, chunk_keys = origins[order], chunk_keys[order]
+    _, group_starts = np.unique(chunk_keys, axis=0, return_index=True)
+    group_bounds = np.append(np.sort(group_starts), len(origins))
+
+    patch_shape = np.array(image.shape)
+    patch_shape[dimension_indicies] = patch_size
+    patch_shape = tuple(int(size) for size in patch_shape)
+
+    batch_bounds = [
+        (start, min(start + batch_size, group_stop))
+        for group_start, group_stop in zip(group_bounds[:-1], group_bounds[1:])
+        for start in range(group_start, group_stop, batch_size)
+    ]
+
+    batches = []
+    for start, stop in batch_bounds:
+        batch_origins = origins[start:stop]
+
+        # Crop the extent of the batch and extract its patches in a single task
+        dimension_min = np.zeros(image.ndim, dtype=int)
+        dimension_max = np.array(image.shape, dtype=int)
+        dimension_min[dimension_indicies] = batch_origins.min(axis=0)
+        dimension_max[dimension_indicies] = batch_origins.max(axis=0) + patch_size
+        region = crop_hyperrectangle(image, dimension_min, dimension_max, dimension_indicies)
+
+        batch = delayed(_extract_patches)(
+            region, batch_origins - dimension_min[dimension_indicies], tuple(patch_size), dimension_indicies
+        )
+        batches.append(da.from_delayed(batch, shape=(len(batch_origins),) + patch_shape, dtype=image.dtype))
+
+    if len(batches) == 0:
+        return (da.empty((0,) + patch_shape, dtype=image.dtype), origins)
+
+    return (da.concatenate(batches, axis=0), origins)
+
+
+def save_patches(patches: da.Array, origins: np.ndarray, directory: str):
+    """Streams the patches to a directory of .npy files (one per batch) with their origins"""
+    da.to_npy_stack(directory, patches, axis=0)
+    np.save(os.path.join(directory, "origins.npy"), origins)
+
+
+def available_memory() -> Optional[int]:
+    """Returns the available memory in bytes (including reclaimable cache), if known"""
+    try:
+        import psutil
+
+        return int(psutil.virtual_memory().available)
+    except ImportError:
+        pass
+
+    # Linux without psutil
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+
+    return None
+
+
+def choose_crop_strategy(
+    is_rectangular: bool,
+    is_mask_only: bool,
+    is_invert_selection: bool,
+    is_trim: bool,
+) -> CropStrategy:
+    """Chooses a slice when keeping a rectangle (masked and trimmed, or cropped), a mask otherwise"""
+    if is_rectangular and is_invert_selection is False and (is_mask_only is False or is_trim is True):
+        return CropStrategy.SLICE
+    return CropStrategy.MASK
+
+
+def choose_mask_layout(mask_size: int, image: da.Array) -> MaskLayout:
+    """Chooses per-block masks when the mask is larger than an image block"""
+    if mask_size > np.prod(image.chunksize, dtype=np.int64):
+        return MaskLayout.PER_BLOCK
+    return MaskLayout.DENSE
+
+
+def _region_chunks(image: da.Array, region_min: np.ndarray, region_max: np.ndarray) -> Tuple[int, int]:
+    """Returns the number of elements and blocks of the image chunks that intersect a region"""
+    n_elements = 1
+    n_blocks = 1
+    for dimension, chunks in enumerate(image.chunks):
+        boundaries = np.cumsum((0,) + chunks)
+        is_intersecting = np.logical_and(
+            boundaries[:-1] < region_max[dimension],
+            boundaries[1:] > region_min[dimension],
+        )
+        n_elements *= int(np.sum(np.asarray(chunks)[is_intersecting]))
+        n_blocks *= int(np.sum(is_intersecting))
+    return (n_elements, n_blocks)
+
+
+def plan_operation(
+    image: da.Array,
+    dimension_min: Sequence[int],
+    dimension_max: Sequence[int],
+    dimension_indicies: Optional[Iterable[int]] = None,
+    is_mask_only: bool = False,
+    mask_value: Any = np.nan,
+    is_invert_selection: bool = False,
+    is_trim: bool = False,
+    n_shapes: Optional[int] = None,
+    execution_mode: ExecutionMode = ExecutionMode.AUTOMATIC,
+    memory_budget: float = 2e9,
+) -> OperationPlan:
+    """
+    Estimates the cost of a crop/mask operation without executing anything and chooses the
+    cheapest strategy. The region is the bounding box of the shapes; n_shapes is given for
+    irregular masks (rasterized shapes) and left as None for rectangles. The execution mode is
+    only chosen (from the memory budget) if it is automatic
+    """
+    if dimension_indicies is None:
+        dimension_indicies = range(len(dimension_min))
+    dimension_indicies = list(dimension_indicies)
+    is_rectangular = n_shapes is None
+
+    # Region of the shapes (masks include their maximum, crops do not)
+    image_shape = np.array(image.shape, dtype=np.int64)
+    region_min = np.zeros(image.ndim, dtype=np.int64)
+    region_max = image_shape.copy()
+    for dimension in dimension_indicies:
+        region_min[dimension] = np.clip(dimension_min[dimension], 0, image_shape[dimension])
+        inclusive_max = dimension_max[dimension] + int(is_mask_only or not is_rectangular)
+        region_max[dimension] = np.clip(inclusive_max, region_min[dimension], image_shape[dimension])
+
+    # Keeping a rectangle only needs a slice, anything else needs a mask
+    strategy = choose_crop_strategy(is_rectangular, is_mask_only, is_invert_selection, is_trim)
+
+    # Only the region is read and produced unless the whole image is masked
+    if is_invert_selection is False and (strategy == CropStrategy.SLICE or is_trim is True):
+        output_min, output_max = region_min, region_max
+    else:
+        output_min, output_max = np.zeros(image.ndim, dtype=np.int64), image_shape
+    n_elements_read, n_blocks = _region_chunks(image, output_min, output_max)
+    itemsize = image.dtype.itemsize
+    if strategy == CropStrategy.MASK and mask_value is not None and np.isnan(mask_value):
+        itemsize = np.dtype(float).itemsize
+    bytes_read = n_elements_read * image.dtype.itemsize
+    bytes_produced = int(np.prod(output_max - output_min)) * itemsize
+
+    # Masks are rasterized over the masked dimensions
+    mask_size = int(np.prod(image_shape[dimension_indicies]))
+    if strategy == CropStrategy.SLICE:
+        rasterization_cost = 0
+    elif is_rectangular:
+        rasterization_cost = mask_size
+    else:
+        rasterization_cost = n_shapes * mask_size
+    mask_layout = choose_mask_layout(mask_size, image)
+
+    # Read blocks, plus the mask layers on each of them
+    n_tasks = n_blocks
+    if strategy == CropStrategy.MASK:
+        n_tasks += 3 * n_blocks + (n_blocks if mask_layout == MaskLayout.PER_BLOCK else 1)
+
+    if execution_mode == ExecutionMode.AUTOMATIC:
+        execution_mode = choose_execution_mode(bytes_produced, memory_budget)
+
+    # Rasterized masks are boolean (one byte per pixel)
+    peak_memory = rasterization_cost * np.dtype(bool).itemsize
+    if execution_mode == ExecutionMode.PERSIST:
+        peak_memory += bytes_produced
+
+    return OperationPlan(
+        strategy=strategy,
+        mask_layout=mask_layout,
+        execution_mode=execution_mode,
+        bytes_read=bytes_read,
+        bytes_produced=bytes_produced,
+        rasterization_cost=rasterization_cost,
+        n_tasks=n_tasks,
+        peak_memory=peak_memory,
+    )
@@ -1,4 +1,5 @@
 from enum import Enum
+from typing import NamedTuple
 
 from numpy import nan
 
@@ -50,3 +51,80 @@ class InclusionMode(Enum):
         if self == InclusionMode.EXCLUDE_SELECTED:
             return True
         return False
+
+
+class ExecutionMode(Enum):
+    """An enum to hold the execution modes of the results"""
+
+    AUTOMATIC = "Automatic (memory budget)"
+    LAZY = "Lazy"
+    PERSIST = "Persist in memory"
+    DISK_CACHE = "Cache on local disk"
+
+    def __str__(self) -> str:
+        """Returns the string representation"""
+        return self.value
+
+
+class Scheduler(Enum):
+    """An enum to hold the dask schedulers used to persist results"""
+
+    THREADS = "threads"
+    PROCESSES = "processes"
+
+    def __str__(self) -> str:
+        """Returns the string representation"""
+        return self.value
+
+
+class CropStrategy(Enum):
+    """An enum to hold the strategies used to compute a crop/mask"""
+
+    SLICE = "Slice"
+    MASK = "Mask"
+
+    def __str__(self) -> str:
+        """Returns the string representation"""
+        return self.value
+
+
+class MaskLayout(Enum):
+    """An enum to hold the layouts of the masks"""
+
+    DENSE = "Dense"
+    PER_BLOCK = "Per block"
+
+    def __str__(self) -> str:
+        """Returns the string representation"""
+        return self.value
+
+
+class OperationPlan(NamedTuple):
+    """The estimated cost of a crop/mask operation and the chosen strategy"""
+
+    strategy: CropStrategy
+    mask_layout: MaskLayout
+    execution_mode: ExecutionMode
+    bytes_read: int
+    bytes_produced: int
+    rasterization_cost: int
+    n_tasks: int
+    peak_memory: int
+
+    def __str__(self) -> str:
+        """Returns a short summary of the plan"""
+        return (
+            f"{self.strategy} ({self.mask_layout} mask), {self.execution_mode}: "
+            f"read {format_bytes(self.bytes_read)}, produce {format_bytes(self.bytes_produced)}, "
+            f"rasterize {self.rasterization_cost:,} px, {self.n_tasks:,} tasks, "
+            f"peak memory {format_bytes(self.peak_memory)}"
+        )
+
+
+def format_bytes(n_bytes: float) -> str:
+    """Returns a human readable size"""
+    for unit in ["B", "KB", "MB", "GB"]:
+        if n_bytes < 1024:
+            return f"{n_bytes:.1f} {unit}"
+        n_bytes = n_bytes / 1024
+    return f"{n_bytes:.1f} TB"